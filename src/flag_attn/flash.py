@@ -1,3 +1,5 @@
+import contextlib
+import functools
 import math
 import torch
 import triton
@@ -7,11 +9,6 @@ import triton.language as tl
 class FlashAttention(torch.autograd.Function):
     @staticmethod
     def forward(ctx, q, k, v, causal, sm_scale):
-        # switch device context
-        orginal_device_index = torch.cuda.current_device()
-        device_index = q.device.index
-        torch.cuda.set_device(device_index)
-
         Dq, Dk, Dv = q.shape[-1], k.shape[-1], v.shape[-1]
         assert Dq == Dk == Dv
         assert Dk in {16, 32, 64, 128}
@@ -20,209 +17,254 @@ class FlashAttention(torch.autograd.Function):
         N = k.shape[2]
         P_SEQ = N - M
         
-        # tune for A100, device_capability(8, 0)
-        if torch.cuda.get_device_capability(device_index) == (8, 0): 
-            if not causal:
-                if Dk <= 64:
-                    BLOCK_M = 128 
-                    BLOCK_N = 64
-                    num_stages = 3
-                    num_warps = 4
-                else:
-                    if M <= 1024:
-                        BLOCK_M = 128
-                        BLOCK_N = 32
-                        num_stages = 3
-                        num_warps = 4
-                    else:
-                        BLOCK_M = 128 
-                        BLOCK_N = 128
-                        num_stages = 3
-                        num_warps = 8
-            else:
-                if Dk <= 64:
-                    BLOCK_M = 128 
-                    BLOCK_N = 64
-                    num_stages = 4
-                    num_warps = 4
-                else:
-                    if M <= 1024:
-                        BLOCK_M = 128
-                        BLOCK_N = 32
-                        num_stages = 2
-                        num_warps = 4
-                    else:
-                        BLOCK_M = 128 
-                        BLOCK_N = 128
-                        num_stages = 3
-                        num_warps = 8
-        else: # tune for RTX-3090, device_capability(8, 6)
-            if not causal:
-                if Dk <= 64:
-                    BLOCK_M = 128 
-                    BLOCK_N = 64
-                    num_stages = 3
-                    num_warps = 4
-                else:
-                    BLOCK_M = 128
-                    BLOCK_N = 32
-                    num_stages = 2
-                    num_warps = 4
-            else: # causal
-                if Dk <= 64:
-                    BLOCK_M = 64
-                    BLOCK_N = 64
-                    num_stages = 3
-                    num_warps = 4
-                else:
-                    BLOCK_M = 128
-                    BLOCK_N = 32
-                    num_stages = 2
-                    num_warps = 4
-
-        divisible_m = M % BLOCK_M == 0
-        divisible_n = N % BLOCK_N == 0
         if sm_scale is None:
             sm_scale = 1. / math.sqrt(D)
 
         # consider using 3d grid to avoid div & rem
-        grid = (triton.cdiv(M, BLOCK_M), H, B)
+        grid = lambda META: (triton.cdiv(M, META["BLOCK_M"]), H, B)
         o = torch.empty_like(q)
         L = torch.empty((B, H, M), device=q.device, dtype=torch.float32)
-        _fwd_kernel[grid](
-            q, k, v, sm_scale,
-            L, o,
-            q.stride(0), q.stride(1), q.stride(2), q.stride(3),
-            k.stride(0), k.stride(1), k.stride(2), k.stride(3),
-            v.stride(0), v.stride(1), v.stride(2), v.stride(3),
-            o.stride(0), o.stride(1), o.stride(2), o.stride(3),
-            B, H, M, P_SEQ,
-            BLOCK_M=BLOCK_M, BLOCK_N=BLOCK_N, BLOCK_DMODEL=D, IS_CAUSAL=causal,
-            DIVISIBLE_M=divisible_m, DIVISIBLE_N=divisible_n, 
-            num_warps=num_warps, num_stages=num_stages,
-        )
+        precision = _dot_precision(q)
+        has_tma = _has_tma(q.device.index) and _tma_compatible(k, v)
+        # the Dot I trick is kept on pre-ampere devices, where the layout
+        # conversion of q does not place it in registers implicitly
+        use_dot_i = _device_capability(q.device.index) < (8, 0)
+        if has_tma:
+            _install_tma_allocator()
+        with _device_context(q.device.index):
+            _fwd_kernel[grid](
+                q, k, v, sm_scale,
+                L, o,
+                q.stride(0), q.stride(1), q.stride(2), q.stride(3),
+                k.stride(0), k.stride(1), k.stride(2), k.stride(3),
+                v.stride(0), v.stride(1), v.stride(2), v.stride(3),
+                o.stride(0), o.stride(1), o.stride(2), o.stride(3),
+                B, H, M, P_SEQ,
+                BLOCK_DMODEL=D, IS_CAUSAL=causal, USE_DOT_I=use_dot_i, P_FP16=_FWD_P_FP16,
+                PRECISION=precision, HAS_TMA=has_tma,
+            )
 
         ctx.save_for_backward(q, k, v, o, L)
-        ctx.grid = grid
         ctx.sm_scale = sm_scale
         ctx.BLOCK_DMODEL = D
         ctx.P_SEQ = P_SEQ
         ctx.causal = causal
-
-        # restore device context
-        torch.cuda.set_device(orginal_device_index)
+        ctx.precision = precision
         return o
 
     @staticmethod
     def backward(ctx, do):
         q, k, v, o, L = ctx.saved_tensors
 
-        # switching device context
-        orginal_device_index = torch.cuda.current_device()
-        device_index = q.device.index
-        torch.cuda.set_device(device_index)
-
         B, H, M, D = q.shape
         N = k.shape[2]
         P_SEQ = N - M
         sm_scale = ctx.sm_scale
         causal = ctx.causal
+        precision = ctx.precision
+
+        with _device_context(q.device.index):
+            dk = torch.empty_like(k)
+            dv = torch.empty_like(v)
+            dq = torch.empty_like(q)
+
+            # dk/dv and dq are computed by independent kernels, on short
+            # sequences the grids are too small to fill the device, so the dq
+            # kernel runs on a side stream to overlap with the dk/dv kernel
+            overlap = M < _OVERLAP_MAX_SEQLEN
+            if overlap:
+                main_stream = torch.cuda.current_stream()
+                side_stream = _side_stream(q.device.index)
+                side_stream.wait_stream(main_stream)
+
+            grid = lambda META: (triton.cdiv(N, META["BLOCK_N"]), H, B)
+            _bwd_kv_kernel[grid](
+                q, k, v, sm_scale, o, do, 
+                dk, dv,
+                L,
+                q.stride(0), q.stride(1), q.stride(2), q.stride(3),
+                k.stride(0), k.stride(1), k.stride(2), k.stride(3),
+                v.stride(0), v.stride(1), v.stride(2), v.stride(3),
+                o.stride(0), o.stride(1), o.stride(2), o.stride(3),
+                do.stride(0), do.stride(1), do.stride(2), do.stride(3),
+                dk.stride(0), dk.stride(1), dk.stride(2), dk.stride(3),
+                dv.stride(0), dv.stride(1), dv.stride(2), dv.stride(3),
+                q.shape[0], q.shape[1], q.shape[2], P_SEQ, 
+                BLOCK_DMODEL=D, CAUSAL=causal, PRECISION=precision,
+            )
+
+            with torch.cuda.stream(side_stream) if overlap else contextlib.nullcontext():
+                grid = lambda META: (triton.cdiv(M, META["BLOCK_M"]), H, B)
+                _bwd_q_kernel[grid](
+                    q, k, v, sm_scale, o, do, 
+                    dq,
+                    L,
+                    q.stride(0), q.stride(1), q.stride(2), q.stride(3),
+                    k.stride(0), k.stride(1), k.stride(2), k.stride(3),
+                    v.stride(0), v.stride(1), v.stride(2), v.stride(3),
+                    o.stride(0), o.stride(1), o.stride(2), o.stride(3),
+                    do.stride(0), do.stride(1), do.stride(2), do.stride(3),
+                    dq.stride(0), dq.stride(1), dq.stride(2), dq.stride(3),
+                    q.shape[0], q.shape[1], q.shape[2], P_SEQ, 
+                    BLOCK_DMODEL=D, CAUSAL=causal, PRECISION=precision,
+                )
+            if overlap:
+                main_stream.wait_stream(side_stream)
 
-        # tune for A100, device_capability(8, 0)
-        if torch.cuda.get_device_capability(device_index) == (8, 0):
-            if not causal:
-                BLOCK_M = 128 if D <= 64 else 64
-                BLOCK_N = 64
-                num_stages = 2
-                num_warps = 4
-            else:
-                BLOCK_M = 64
-                BLOCK_N = 64
-                num_stages = 3 if D <= 64 else 2
-                num_warps = 4
-        else: # tune for RTX-3090, device_capability(8, 6)
-            if not causal:
-                if D <= 64:
-                    BLOCK_M = 64
-                    BLOCK_N = 64
-                    num_stages = 2
-                    num_warps = 4
-                else:
-                    BLOCK_M = 64
-                    BLOCK_N = 64
-                    num_stages = 2
-                    num_warps = 8
-            else:
-                if D <= 64:
-                    BLOCK_M = 64
-                    BLOCK_N = 64
-                    num_stages = 2
-                    num_warps = 4
-                else:
-                    BLOCK_M = 32
-                    BLOCK_N = 32
-                    num_stages = 2
-                    num_warps = 4
-        
-        divisible_m = M % BLOCK_M == 0
-        divisible_n = N % BLOCK_N == 0
-
-        delta = torch.empty_like(L)
-        grid = (triton.cdiv(M, BLOCK_M), H, B)
-        _bwd_preprocess[grid](
-            o, do,
-            delta,
-            o.stride(0), o.stride(1), o.stride(2), o.stride(3),
-            do.stride(0), do.stride(1), do.stride(2), do.stride(3),
-            delta.stride(0), delta.stride(1), delta.stride(2),
-            M,
-            BLOCK_M=BLOCK_M, D_HEAD=D,
-            DIVISIBLE_M=divisible_m,
-        )
+        return dq, dk, dv, None, None, None
 
-        dk = torch.empty_like(k)
-        dv = torch.empty_like(v)
-        grid = (triton.cdiv(N, BLOCK_N), H, B)
-        _bwd_kv_kernel[grid](
-            q, k, v, sm_scale, do, 
-            dk, dv,
-            L, delta,
-            q.stride(0), q.stride(1), q.stride(2), q.stride(3),
-            k.stride(0), k.stride(1), k.stride(2), k.stride(3),
-            v.stride(0), v.stride(1), v.stride(2), v.stride(3),
-            do.stride(0), do.stride(1), do.stride(2), do.stride(3),
-            dk.stride(0), dk.stride(1), dk.stride(2), dk.stride(3),
-            dv.stride(0), dv.stride(1), dv.stride(2), dv.stride(3),
-            q.shape[0], q.shape[1], q.shape[2], P_SEQ, 
-            BLOCK_M=BLOCK_M, BLOCK_DMODEL=D, BLOCK_N=BLOCK_N, CAUSAL=causal,
-            DIVISIBLE_M=divisible_m, DIVISIBLE_N=divisible_n,
-            num_stages=num_stages, num_warps=num_warps,
-        )
+def attention(q, k, v, causal=False, sm_scale=None):
+    return FlashAttention.apply(q, k, v, causal, sm_scale)
 
-        dq = torch.zeros_like(q) # us float32 for atomic updates
-        grid = (triton.cdiv(M, BLOCK_M), H, B)
-        _bwd_q_kernel[grid](
-            q, k, v, sm_scale, do, 
-            dq,
-            L, delta,
-            q.stride(0), q.stride(1), q.stride(2), q.stride(3),
-            k.stride(0), k.stride(1), k.stride(2), k.stride(3),
-            v.stride(0), v.stride(1), v.stride(2), v.stride(3),
-            do.stride(0), do.stride(1), do.stride(2), do.stride(3),
-            dq.stride(0), dq.stride(1), dq.stride(2), dq.stride(3),
-            q.shape[0], q.shape[1], q.shape[2], P_SEQ, 
-            BLOCK_M=BLOCK_M, BLOCK_DMODEL=D, BLOCK_N=BLOCK_N, CAUSAL=causal,
-            DIVISIBLE_M=divisible_m, DIVISIBLE_N=divisible_n,
-            num_stages=num_stages, num_warps = num_warps,
-        )
 
+@contextlib.contextmanager
+def _device_context(device_index):
+    # triton launches on the current device, switching it is a blocking driver
+    # call, so it is only done when q lives on another device
+    orginal_device_index = torch.cuda.current_device()
+    if device_index == orginal_device_index:
+        yield
+        return
+    torch.cuda.set_device(device_index)
+    try:
+        yield
+    finally:
         torch.cuda.set_device(orginal_device_index)
-        return dq, dk, dv, None, None, None
 
-def attention(q, k, v, causal=False, sm_scale=None):
-    return FlashAttention.apply(q, k, v, causal, sm_scale)
 
+@functools.lru_cache(maxsize=None)
+def _device_capability(device_index):
+    return torch.cuda.get_device_capability(device_index)
+
+
+def _dot_precision(q):
+    # the input precision of tl.dot follows torch's float32 matmul precision,
+    # so fp32 inputs get full fp32 dots under torch's default "highest", 3xtf32
+    # under "high" and tf32 under "medium". It is a no-op for 16-bit inputs
+    if q.dtype != torch.float32:
+        return "tf32"
+    if _device_capability(q.device.index) < (8, 0):
+        return "ieee" # no tf32 tensor cores before ampere
+    return {"highest": "ieee", "high": "tf32x3"}.get(torch.get_float32_matmul_precision(), "tf32")
+
+
+def _has_tma(device_index):
+    return hasattr(tl, "make_tensor_descriptor") and _device_capability(device_index) >= (9, 0)
+
+
+def _tma_compatible(*tensors):
+    # TMA needs 16-byte aligned bases and strides and a contiguous last dim
+    return all(
+        t.stride(-1) == 1 and t.data_ptr() % 16 == 0
+        and all(stride * t.element_size() % 16 == 0 for stride in t.stride()[:-1])
+        for t in tensors
+    )
+
+
+def _tma_allocator(size, alignment, stream):
+    return torch.empty(size, device="cuda", dtype=torch.int8)
+
+
+def _install_tma_allocator():
+    # device-side tensor descriptors need global scratch memory. An allocator
+    # installed by the caller is kept, ours only fills in when there is none
+    from triton.runtime import _allocation
+    allocator = _allocation._allocator
+    if hasattr(allocator, "get"): # a ContextVar in newer triton
+        allocator = allocator.get()
+    if isinstance(allocator, _allocation.NullAllocator):
+        triton.set_allocator(_tma_allocator)
+
+
+# keep the forward softmax tile p in the input dtype, see _fwd_block. It changes
+# how the row sums round, so it is a fixed choice rather than an autotune axis,
+# the output must not depend on which config wins the timing
+_FWD_P_FP16 = True
+
+
+# the dq kernel overlaps the dk/dv kernel below this query length
+_OVERLAP_MAX_SEQLEN = 2048
+
+
+@functools.lru_cache(maxsize=None)
+def _side_stream(device_index):
+    return torch.cuda.Stream(device_index)
 
+
+@triton.jit
+def _swizzle_hz(H, Z, GROUP_H: tl.constexpr):
+    # remap the (head, batch) program ids so that consecutive programs walk
+    # the batch within a group of GROUP_H heads, as grouped ordering in matmul
+    pid = tl.program_id(2) * H + tl.program_id(1)
+    num_pid_in_group = GROUP_H * Z
+    first_h = (pid // num_pid_in_group) * GROUP_H
+    group_size = tl.minimum(H - first_h, GROUP_H)
+    off_h = first_h + (pid % num_pid_in_group) % group_size
+    off_z = (pid % num_pid_in_group) // group_size
+    return off_h, off_z
+
+
+# (BLOCK_M, BLOCK_N, num_warps, num_stages, GROUP_H). Only the tiling, the
+# program order and (in the forward) the TMA path are tuned, they do not change
+# the numerics. The other constexprs are set by the launcher, so a new key
+# benchmarks a handful of configs
+_fwd_configs = [
+    (128, 64, 4, 3, 1),
+    (128, 128, 8, 3, 1),
+    (64, 64, 4, 3, 1),
+    (128, 32, 4, 2, 1),
+    (128, 64, 8, 4, 1),
+    (64, 32, 4, 2, 1),
+    (128, 64, 4, 3, 8),
+    (64, 64, 4, 3, 8),
+]
+
+
+def _prune_fwd_configs(configs, named_args, **kwargs):
+    # the TMA configs need hopper and a layout TMA can describe
+    if kwargs["HAS_TMA"]:
+        return configs
+    return [config for config in configs if not config.kwargs["USE_TMA"]]
+
+
+# the dk/dv kernel keeps k and v resident and favors wide BLOCK_N
+_bwd_kv_configs = [
+    (64, 64, 4, 2, 1),
+    (64, 64, 4, 3, 1),
+    (64, 64, 8, 2, 1),
+    (32, 64, 4, 2, 1),
+    (32, 128, 4, 2, 1),
+    (64, 128, 8, 2, 1),
+    (64, 64, 4, 2, 8),
+    (32, 128, 4, 2, 8),
+]
+
+# the dq kernel keeps q and do resident and favors tall BLOCK_M
+_bwd_q_configs = [
+    (64, 64, 4, 2, 1),
+    (64, 64, 4, 3, 1),
+    (64, 64, 8, 2, 1),
+    (64, 32, 4, 2, 1),
+    (128, 32, 4, 2, 1),
+    (128, 64, 8, 2, 1),
+    (64, 64, 4, 2, 8),
+    (128, 32, 4, 2, 8),
+]
+
+
+@triton.autotune(
+    configs=[
+        triton.Config({"BLOCK_M": m, "BLOCK_N": n, "GROUP_H": g, "USE_TMA": tma}, num_warps=w, num_stages=s)
+        for m, n, w, s, g in _fwd_configs for tma in [False, True]
+    ],
+    key=["N_CTX", "P_SEQ", "BLOCK_DMODEL", "IS_CAUSAL", "HAS_TMA"],
+    prune_configs_by={"early_config_prune": _prune_fwd_configs},
+)
+@triton.heuristics({
+    "DIVISIBLE_M": lambda args: args["N_CTX"] % args["BLOCK_M"] == 0,
+    "DIVISIBLE_N": lambda args: (args["N_CTX"] + args["P_SEQ"]) % args["BLOCK_N"] == 0,
+    "CONTIGUOUS": lambda args: all(args[name].is_contiguous() for name in ("Q", "K", "V", "O")),
+})
 @triton.jit
 def _fwd_kernel(
     Q, K, V, sm_scale,
@@ -234,13 +276,14 @@ def _fwd_kernel(
     Z, H, N_CTX, P_SEQ,
     BLOCK_M: tl.constexpr, BLOCK_DMODEL: tl.constexpr, BLOCK_N: tl.constexpr, 
     IS_CAUSAL: tl.constexpr,
-    DIVISIBLE_M: tl.constexpr, DIVISIBLE_N: tl.constexpr,
+    DIVISIBLE_M: tl.constexpr, DIVISIBLE_N: tl.constexpr, CONTIGUOUS: tl.constexpr,
+    USE_DOT_I: tl.constexpr = False, GROUP_H: tl.constexpr = 1, P_FP16: tl.constexpr = True,
+    PRECISION: tl.constexpr = "tf32", HAS_TMA: tl.constexpr = False, USE_TMA: tl.constexpr = False,
 ):
     input_dtype = Q.dtype.element_ty
     # -- grid id --
     start_m = tl.program_id(0)
-    off_h = tl.program_id(1)
-    off_z = tl.program_id(2)
+    off_h, off_z = _swizzle_hz(H, Z, GROUP_H)
 
     # scale sm_scale by log_2(e) and use
     # 2^x instead of exp in the loop because CSE and LICM
@@ -248,6 +291,21 @@ def _fwd_kernel(
     log2e: tl.constexpr = 1.4426950408889634
     qk_scale = sm_scale * log2e
 
+    if CONTIGUOUS:
+        # dense (B, H, T, D) tensors: the strides follow from the shapes and
+        # the innermost two are known at compile time. The outer two are built
+        # in int64, a batch can hold 2^31 elements or more
+        stride_qk = 1
+        stride_qm = BLOCK_DMODEL
+        stride_qh = tl.cast(N_CTX, tl.int64) * BLOCK_DMODEL
+        stride_qz = H * stride_qh
+        stride_ok, stride_om, stride_oh, stride_oz = stride_qk, stride_qm, stride_qh, stride_qz
+        stride_kk = 1
+        stride_kn = BLOCK_DMODEL
+        stride_kh = tl.cast(N_CTX + P_SEQ, tl.int64) * BLOCK_DMODEL
+        stride_kz = H * stride_kh
+        stride_vk, stride_vn, stride_vh, stride_vz = stride_kk, stride_kn, stride_kh, stride_kz
+
     # offset pointers for (batch, head)
     Q += off_z * stride_qz + off_h * stride_qh
     K += off_z * stride_kz + off_h * stride_kh
@@ -261,8 +319,14 @@ def _fwd_kernel(
     offs_k = tl.arange(0, BLOCK_DMODEL)
 
     # initialize pointers to value-like data 
-    q_ptrs = Q + (offs_m[:, None] * stride_qm + offs_k[None, :] * stride_qk) # (BLOCK_M, BLOCK_DMODEL)
-    o_ptrs = O + (offs_m[:, None] * stride_om + offs_k[None, :] * stride_ok) # (BLOCK_M, BLOCK_DMODEL)
+    Q_block_ptr = tl.make_block_ptr(
+        base=Q, shape=(N_CTX, BLOCK_DMODEL), strides=(stride_qm, stride_qk),
+        offsets=(start_m * BLOCK_M, 0), block_shape=(BLOCK_M, BLOCK_DMODEL), order=(1, 0),
+    )
+    O_block_ptr = tl.make_block_ptr(
+        base=O, shape=(N_CTX, BLOCK_DMODEL), strides=(stride_om, stride_ok),
+        offsets=(start_m * BLOCK_M, 0), block_shape=(BLOCK_M, BLOCK_DMODEL), order=(1, 0),
+    )
     l_ptrs = L + offs_m
 
     # initialize pointer to m and l, fp32 for accumulators
@@ -272,135 +336,189 @@ def _fwd_kernel(
 
     # load q
     if DIVISIBLE_M:
-        q = tl.load(q_ptrs, cache_modifier=".cg")
+        q = tl.load(Q_block_ptr, cache_modifier=".cg")
     else:
         mask_m = offs_m < N_CTX
-        q = tl.load(q_ptrs, mask=mask_m[:, None], cache_modifier=".cg")
-    
+        q = tl.load(Q_block_ptr, boundary_check=(0,), padding_option="zero", cache_modifier=".cg")
+    # fold qk_scale into q once, so that qk comes out of the dot already in
+    # log2 units and the loop saves a multiply per score
+    q = (q.to(tl.float32) * qk_scale).to(input_dtype)
+
     #Dot I trick: to place q in registers, it saves shared memory
-    if BLOCK_DMODEL < 128:
+    if USE_DOT_I and BLOCK_DMODEL < 128:
         I = tl.where(offs_k[:, None] == offs_k,
                      tl.full((BLOCK_DMODEL, BLOCK_DMODEL), 1.0, dtype=input_dtype),
                      tl.full((BLOCK_DMODEL, BLOCK_DMODEL), 0.0, dtype=input_dtype))
-        q = tl.dot(q, I).to(input_dtype)
+        q = tl.dot(q, I, input_precision=PRECISION).to(input_dtype)
     # else:
     #     I = tl.where(offs_m_base[:, None] == offs_m_base,
     #                  tl.full((BLOCK_M, BLOCK_M), 1.0, dtype=input_dtype),
     #                  tl.full((BLOCK_M, BLOCK_M), 0.0, dtype=input_dtype))
     #     q = tl.dot(I, q).to(input_dtype)
 
+    # loop over k, v and update accumulators
+    if USE_TMA:
+        # on hopper, k and v tiles are copied from global to shared memory by
+        # the tensor memory accelerator, the launcher checks the layout for it
+        K_block_ptr = tl.make_tensor_descriptor(
+            K, shape=[N_CTX + P_SEQ, BLOCK_DMODEL], strides=[stride_kn, 1],
+            block_shape=[BLOCK_N, BLOCK_DMODEL],
+        )
+        V_block_ptr = tl.make_tensor_descriptor(
+            V, shape=[N_CTX + P_SEQ, BLOCK_DMODEL], strides=[stride_vn, 1],
+            block_shape=[BLOCK_N, BLOCK_DMODEL],
+        )
+    else:
+        K_block_ptr = tl.make_block_ptr(
+            base=K, shape=(BLOCK_DMODEL, N_CTX + P_SEQ), strides=(stride_kk, stride_kn),
+            offsets=(0, 0), block_shape=(BLOCK_DMODEL, BLOCK_N), order=(0, 1),
+        ) # (BLOCK_DMODEL, BLOCK_N)
+        V_block_ptr = tl.make_block_ptr(
+            base=V, shape=(N_CTX + P_SEQ, BLOCK_DMODEL), strides=(stride_vn, stride_vk),
+            offsets=(0, 0), block_shape=(BLOCK_N, BLOCK_DMODEL), order=(1, 0),
+        ) # (BLOCK_N, BLOCK_DMODEL)
     if IS_CAUSAL:
-        hi = P_SEQ + (start_m + 1) * BLOCK_M
+        hi = tl.minimum(P_SEQ + (start_m + 1) * BLOCK_M, N_CTX + P_SEQ)
+        # k blocks left of the diagonal are fully visible to this q block, so
+        # they need neither causal masking nor masking of the tail of k
+        diag_start = (P_SEQ + start_m * BLOCK_M) // BLOCK_N * BLOCK_N
+        acc, l_i, m_i, K_block_ptr, V_block_ptr = _fwd_inner(
+            acc, l_i, m_i, q, K_block_ptr, V_block_ptr,
+            offs_m, offs_n_base, 0, diag_start, N_CTX, P_SEQ,
+            BLOCK_N=BLOCK_N, MASK_CAUSAL=False, DIVISIBLE_N=True, P_FP16=P_FP16,
+            PRECISION=PRECISION, USE_TMA=USE_TMA,
+        )
+        acc, l_i, m_i, K_block_ptr, V_block_ptr = _fwd_inner(
+            acc, l_i, m_i, q, K_block_ptr, V_block_ptr,
+            offs_m, offs_n_base, diag_start, hi, N_CTX, P_SEQ,
+            BLOCK_N=BLOCK_N, MASK_CAUSAL=True, DIVISIBLE_N=DIVISIBLE_N, P_FP16=P_FP16,
+            PRECISION=PRECISION, USE_TMA=USE_TMA,
+        )
     else:
-        hi = N_CTX + P_SEQ
-
-    # loop over k, v and update accumulators
-    offs_n_init = offs_n_base
-    k_ptrs = K + (offs_k[:, None] * stride_vk + offs_n_init[None, :] * stride_vn) # (BLOCK_DMODEL, BLOCK_N)
-    v_ptrs = V + (offs_n_init[:, None] * stride_kn + offs_k[None, :] * stride_kk) # (BLOCK_N, BLOCK_DMODEL)
-    for start_n in range(0, hi, BLOCK_N):
-        start_n = tl.multiple_of(start_n, BLOCK_N)
-        offs_n = start_n + offs_n_base
-        
-        # -- load k, v --
-        if DIVISIBLE_N:
-            k = tl.load(k_ptrs, cache_modifier=".cg")
-            v = tl.load(v_ptrs, cache_modifier=".cg")
-        else:
-            mask_n = offs_n < (N_CTX + P_SEQ)
-            k = tl.load(k_ptrs, mask=mask_n[None, :], cache_modifier=".cg")
-            v = tl.load(v_ptrs, mask=mask_n[:, None], cache_modifier=".cg")
-
-        # -- compute qk ---
-        s = tl.zeros([BLOCK_M, BLOCK_N], dtype=tl.float32)
-        s += tl.dot(q, k)
-        
+        # only the last k block can be partial, it is peeled off so that the
+        # other blocks skip the masking of the tail of k
+        n_full = (N_CTX + P_SEQ) // BLOCK_N * BLOCK_N
+        acc, l_i, m_i, K_block_ptr, V_block_ptr = _fwd_inner(
+            acc, l_i, m_i, q, K_block_ptr, V_block_ptr,
+            offs_m, offs_n_base, 0, n_full, N_CTX, P_SEQ,
+            BLOCK_N=BLOCK_N, MASK_CAUSAL=False, DIVISIBLE_N=True, P_FP16=P_FP16,
+            PRECISION=PRECISION, USE_TMA=USE_TMA,
+        )
         if not DIVISIBLE_N:
-            s = tl.where(mask_n[None, :], s, float("-inf"))
-        if IS_CAUSAL:
-            causal_mask = (P_SEQ + offs_m[:, None]) >= offs_n[None, :]
-            s = tl.where(causal_mask, s, float("-inf"))
-
-        # -- compute scaling constant ---
-        m_i_new = tl.maximum(m_i, tl.max(s, 1))
-        alpha = tl.math.exp2((m_i - m_i_new) * qk_scale)
-        p = tl.math.exp2(s * qk_scale - m_i_new[:, None] * qk_scale)
-
-        # -- scale and update acc: acc *= alpha[:, None]--
-        acc *= alpha[:, None]
-        acc += tl.dot(p.to(input_dtype), v)
-
-        # -- update m_i and l_i --
-        l_i = l_i * alpha + tl.sum(p, 1)
-        m_i = m_i_new
-        # update pointers
-        k_ptrs += BLOCK_N * stride_kn
-        v_ptrs += BLOCK_N * stride_vn
+            acc, l_i, m_i, K_block_ptr, V_block_ptr = _fwd_inner(
+                acc, l_i, m_i, q, K_block_ptr, V_block_ptr,
+                offs_m, offs_n_base, n_full, N_CTX + P_SEQ, N_CTX, P_SEQ,
+                BLOCK_N=BLOCK_N, MASK_CAUSAL=False, DIVISIBLE_N=False, P_FP16=P_FP16,
+                PRECISION=PRECISION, USE_TMA=USE_TMA,
+            )
 
     # write back l & o
-    acc = acc * (1.0 / l_i[:, None])
-    l = m_i * sm_scale + tl.log(l_i) # log(normalizer)
+    # the reciprocal of the normalizer does not need an ieee-rounded divide
+    acc = acc * tl.fdiv(1.0, l_i)[:, None]
+    l = m_i + tl.math.log2(l_i) # log2(normalizer)
     if DIVISIBLE_M:
         tl.store(l_ptrs, l, cache_modifier=".cg")
-        tl.store(o_ptrs, acc.to(input_dtype), cache_modifier=".cg")
+        tl.store(O_block_ptr, acc.to(input_dtype), cache_modifier=".cg")
     else:
         tl.store(l_ptrs, l, mask=mask_m, cache_modifier=".cg")
-        tl.store(o_ptrs, acc.to(input_dtype), mask=mask_m[:, None], cache_modifier=".cg")
+        tl.store(O_block_ptr, acc.to(input_dtype), boundary_check=(0,), cache_modifier=".cg")
 
 
 
 @triton.jit
-def _bwd_preprocess(
-    Out, DO,
-    Delta,
-    stride_oz, stride_oh, stride_om, stride_ok,
-    stride_doz, stride_doh, stride_dom, stride_dok,
-    stride_dz, stride_dh, stride_dm,
-    M,
-    BLOCK_M: tl.constexpr, D_HEAD: tl.constexpr,
-    DIVISIBLE_M: tl.constexpr,
+def _fwd_inner(
+    acc, l_i, m_i, q, K_block_ptr, V_block_ptr,
+    offs_m, offs_n_base, lo, hi, N_CTX, P_SEQ,
+    BLOCK_N: tl.constexpr, MASK_CAUSAL: tl.constexpr, DIVISIBLE_N: tl.constexpr,
+    P_FP16: tl.constexpr, PRECISION: tl.constexpr, USE_TMA: tl.constexpr,
 ):
-    off_h = tl.program_id(1)
-    off_z = tl.program_id(2)
-    Out += off_z * stride_oz + off_h * stride_oh
-    DO += off_z * stride_doz + off_h * stride_doh
-    Delta += off_z * stride_dz + off_h * stride_dh
-
-    # compute (Out * Dout).sum() for vector interpretation
-    off_m = tl.program_id(0) * BLOCK_M + tl.arange(0, BLOCK_M)        
-    off_n = tl.arange(0, D_HEAD)
+    # a runtime loop, also for the short diagonal part, so that it keeps the
+    # num_stages software pipelining
+    for start_n in range(lo, hi, BLOCK_N):
+        start_n = tl.multiple_of(start_n, BLOCK_N)
+        acc, l_i, m_i = _fwd_block(
+            acc, l_i, m_i, q, K_block_ptr, V_block_ptr,
+            offs_m, offs_n_base, start_n, N_CTX, P_SEQ,
+            MASK_CAUSAL=MASK_CAUSAL, DIVISIBLE_N=DIVISIBLE_N, P_FP16=P_FP16, PRECISION=PRECISION,
+            USE_TMA=USE_TMA,
+        )
+        # update pointers, descriptors are indexed by start_n instead
+        if not USE_TMA:
+            K_block_ptr = tl.advance(K_block_ptr, (0, BLOCK_N))
+            V_block_ptr = tl.advance(V_block_ptr, (BLOCK_N, 0))
+    return acc, l_i, m_i, K_block_ptr, V_block_ptr
 
-    # load
-    o_ptrs = Out + off_m[:, None] * stride_om + off_n[None, :] * stride_ok
-    do_ptrs = DO + off_m[:, None] * stride_dom + off_n[None, :] * stride_dok
 
-    if DIVISIBLE_M:
-        o = tl.load(o_ptrs).to(tl.float32)
-        do = tl.load(do_ptrs).to(tl.float32)
-    if not DIVISIBLE_M:
-        mask_m = off_m < M
-        o = tl.load(o_ptrs, mask=mask_m[:, None]).to(tl.float32)
-        do = tl.load(do_ptrs, mask=mask_m[:, None]).to(tl.float32)
-    
-    # compute
-    delta = tl.sum(o * do, axis=1)
-    # write-back
-    d_ptrs = Delta + off_m * stride_dm
-    if DIVISIBLE_M:
-        tl.store(d_ptrs, delta)
+@triton.jit
+def _fwd_block(
+    acc, l_i, m_i, q, K_block_ptr, V_block_ptr,
+    offs_m, offs_n_base, start_n, N_CTX, P_SEQ,
+    MASK_CAUSAL: tl.constexpr, DIVISIBLE_N: tl.constexpr, P_FP16: tl.constexpr,
+    PRECISION: tl.constexpr, USE_TMA: tl.constexpr,
+):
+    input_dtype = q.dtype
+    offs_n = start_n + offs_n_base
+    # -- load k, v --
+    if USE_TMA:
+        # out of bound rows are zero filled by the copy
+        k = tl.trans(K_block_ptr.load([start_n, 0]))
+        v = V_block_ptr.load([start_n, 0])
+    elif DIVISIBLE_N:
+        k = tl.load(K_block_ptr, cache_modifier=".cg")
+        v = tl.load(V_block_ptr, cache_modifier=".cg")
     else:
-        tl.store(d_ptrs, delta, mask=mask_m)
-
+        k = tl.load(K_block_ptr, boundary_check=(1,), padding_option="zero", cache_modifier=".cg")
+        v = tl.load(V_block_ptr, boundary_check=(0,), padding_option="zero", cache_modifier=".cg")
 
+    # -- compute qk ---
+    s = tl.dot(q, k, input_precision=PRECISION)
+    
+    if not DIVISIBLE_N:
+        mask_n = offs_n < (N_CTX + P_SEQ)
+        s = tl.where(mask_n[None, :], s, float("-inf"))
+    if MASK_CAUSAL:
+        causal_mask = (P_SEQ + offs_m[:, None]) >= offs_n[None, :]
+        s = tl.where(causal_mask, s, float("-inf"))
+
+    # -- compute scaling constant ---
+    m_i_new = tl.maximum(m_i, tl.max(s, 1))
+    alpha = tl.math.exp2(m_i - m_i_new)
+    p = tl.math.exp2(s - m_i_new[:, None])
+    if P_FP16:
+        # keep p in the input dtype, which halves its register footprint,
+        # the row sum is still accumulated in fp32
+        p = p.to(input_dtype)
+
+    # -- scale and update acc: acc = acc * alpha[:, None] + p @ v --
+    # the rescaled acc is fed to the mma as its accumulator operand
+    acc = tl.dot(p.to(input_dtype), v, acc=acc * alpha[:, None], input_precision=PRECISION)
+
+    # -- update m_i and l_i --
+    l_i = l_i * alpha + tl.sum(p.to(tl.float32), 1)
+    m_i = m_i_new
+    return acc, l_i, m_i
+
+
+@triton.autotune(
+    configs=[
+        triton.Config({"BLOCK_M": m, "BLOCK_N": n, "GROUP_H": g}, num_warps=w, num_stages=s)
+        for m, n, w, s, g in _bwd_kv_configs
+    ],
+    key=["N_CTX", "P_SEQ", "BLOCK_DMODEL", "CAUSAL"],
+)
+@triton.heuristics({
+    "DIVISIBLE_M": lambda args: args["N_CTX"] % args["BLOCK_M"] == 0,
+    "DIVISIBLE_N": lambda args: (args["N_CTX"] + args["P_SEQ"]) % args["BLOCK_N"] == 0,
+})
 @triton.jit
 def _bwd_kv_kernel(
-    Q, K, V, sm_scale, DO,
+    Q, K, V, sm_scale, O, DO,
     DK, DV,
     L,
-    D,
     stride_qz, stride_qh, stride_qm, stride_qk,
     stride_kz, stride_kh, stride_kn, stride_kk,
     stride_vz, stride_vh, stride_vn, stride_vk,
+    stride_oz, stride_oh, stride_om, stride_ok,
     stride_doz, stride_doh, stride_dom, stride_dok,
     stride_dkz, stride_dkh, stride_dkn, stride_dkk,
     stride_dvz, stride_dvh, stride_dvn, stride_dvk,
@@ -408,12 +526,12 @@ def _bwd_kv_kernel(
     BLOCK_M: tl.constexpr, BLOCK_DMODEL: tl.constexpr, BLOCK_N: tl.constexpr,
     CAUSAL: tl.constexpr,
     DIVISIBLE_M: tl.constexpr, DIVISIBLE_N: tl.constexpr,
+    GROUP_H: tl.constexpr = 1, PRECISION: tl.constexpr = "tf32",
 ):
     input_dtype = Q.dtype.element_ty
     # -- grid id --
     start_n = tl.program_id(0)
-    off_h = tl.program_id(1)
-    off_z = tl.program_id(2)
+    off_h, off_z = _swizzle_hz(H, Z, GROUP_H)
     log2e: tl.constexpr = 1.4426950408889634
     qk_scale = sm_scale * log2e
 
@@ -421,6 +539,7 @@ def _bwd_kv_kernel(
     Q += off_z * stride_qz + off_h * stride_qh
     K += off_z * stride_kz + off_h * stride_kh
     V += off_z * stride_vz + off_h * stride_vh
+    O += off_z * stride_oz + off_h * stride_oh
     DO += off_z * stride_doz + off_h * stride_doh
 
     # offset pointers for batch/head
@@ -428,58 +547,127 @@ def _bwd_kv_kernel(
     DV += off_z * stride_dvz + off_h * stride_dvh
 
     # offset pointers for batch/head
-    D += (off_z * H + off_h) * N_CTX
     L += (off_z * H + off_h) * N_CTX
 
     if CAUSAL:
-        lo = tl.math.max(start_n * BLOCK_N - P_SEQ, 0)
+        lo = tl.maximum(start_n * BLOCK_N - P_SEQ, 0)
         lo = (lo // BLOCK_M) * BLOCK_M
     else:
         lo = 0
 
-    offs_m_init = lo + tl.arange(0, BLOCK_M)
     offs_n = start_n * BLOCK_N + tl.arange(0, BLOCK_N)
     offs_m_base = tl.arange(0, BLOCK_M)
-    offs_k = tl.arange(0, BLOCK_DMODEL)
     
     # initialize pointers to value-like data 
-    q_ptrs = Q + (offs_m_init[:, None] * stride_qm + offs_k[None, :] * stride_qk) # (BLOCK_M, BLOCK_DMODEL)
-    k_ptrs = K + (offs_n[:, None] * stride_kn + offs_k[None, :] * stride_kk) # (BLOCK_N, BLOCK_DMODEL)
-    v_ptrs = V + (offs_n[:, None] * stride_vn + offs_k[None, :] * stride_vk) # (BLOCK_N, BLOCK_DMODEL)
-    do_ptrs = DO + (offs_m_init[:, None] * stride_dom + offs_k[None, :] * stride_dok) # (BLOCK_M, BLOCK_DMODEL)
-
-    dv_ptrs = DV + (offs_n[:, None] * stride_dvn + offs_k[None, :] * stride_dvk) # (BLOCK_N, BLOCK_DMODEL)
-    dk_ptrs = DK + (offs_n[:, None] * stride_dkn + offs_k[None, :] * stride_dkk) # (BLOCK_N, BLOCK_DMODEL)
+    # q is loaded transposed so that scores are computed as s^T = k @ q^T, which
+    # makes p^T and ds^T the left operands of dv and dk without transposition
+    QT_block_ptr = tl.make_block_ptr(
+        base=Q, shape=(BLOCK_DMODEL, N_CTX), strides=(stride_qk, stride_qm),
+        offsets=(0, lo), block_shape=(BLOCK_DMODEL, BLOCK_M), order=(0, 1),
+    )
+    K_block_ptr = tl.make_block_ptr(
+        base=K, shape=(N_CTX + P_SEQ, BLOCK_DMODEL), strides=(stride_kn, stride_kk),
+        offsets=(start_n * BLOCK_N, 0), block_shape=(BLOCK_N, BLOCK_DMODEL), order=(1, 0),
+    )
+    V_block_ptr = tl.make_block_ptr(
+        base=V, shape=(N_CTX + P_SEQ, BLOCK_DMODEL), strides=(stride_vn, stride_vk),
+        offsets=(start_n * BLOCK_N, 0), block_shape=(BLOCK_N, BLOCK_DMODEL), order=(1, 0),
+    )
+    O_block_ptr = tl.make_block_ptr(
+        base=O, shape=(N_CTX, BLOCK_DMODEL), strides=(stride_om, stride_ok),
+        offsets=(lo, 0), block_shape=(BLOCK_M, BLOCK_DMODEL), order=(1, 0),
+    )
+    DO_block_ptr = tl.make_block_ptr(
+        base=DO, shape=(N_CTX, BLOCK_DMODEL), strides=(stride_dom, stride_dok),
+        offsets=(lo, 0), block_shape=(BLOCK_M, BLOCK_DMODEL), order=(1, 0),
+    )
+
+    DV_block_ptr = tl.make_block_ptr(
+        base=DV, shape=(N_CTX + P_SEQ, BLOCK_DMODEL), strides=(stride_dvn, stride_dvk),
+        offsets=(start_n * BLOCK_N, 0), block_shape=(BLOCK_N, BLOCK_DMODEL), order=(1, 0),
+    )
+    DK_block_ptr = tl.make_block_ptr(
+        base=DK, shape=(N_CTX + P_SEQ, BLOCK_DMODEL), strides=(stride_dkn, stride_dkk),
+        offsets=(start_n * BLOCK_N, 0), block_shape=(BLOCK_N, BLOCK_DMODEL), order=(1, 0),
+    )
 
     # k and v stay in SRAM throughout
     if DIVISIBLE_N:
-        v = tl.load(v_ptrs)
-        k = tl.load(k_ptrs)
+        v = tl.load(V_block_ptr)
+        k = tl.load(K_block_ptr)
     else:
-        mask_n = offs_n < (N_CTX + P_SEQ)
-        v = tl.load(v_ptrs, mask=mask_n[:, None])
-        k = tl.load(k_ptrs, mask=mask_n[:, None])
+        v = tl.load(V_block_ptr, boundary_check=(0,), padding_option="zero")
+        k = tl.load(K_block_ptr, boundary_check=(0,), padding_option="zero")
 
     # initialize dk amd dv
     dk = tl.zeros([BLOCK_N, BLOCK_DMODEL], dtype=tl.float32)
     dv = tl.zeros([BLOCK_N, BLOCK_DMODEL], dtype=tl.float32)
     
     # loop over a col
-    for start_m in range(lo, N_CTX, BLOCK_M):
+    if CAUSAL:
+        # q blocks below the diagonal see the whole k block, so they need no
+        # causal masking
+        diag_end = (tl.maximum((start_n + 1) * BLOCK_N - P_SEQ, 0) + BLOCK_M - 1) // BLOCK_M * BLOCK_M
+        diag_end = tl.minimum(diag_end, N_CTX)
+        dk, dv, QT_block_ptr, O_block_ptr, DO_block_ptr = _bwd_kv_inner(
+            dk, dv, k, v, QT_block_ptr, O_block_ptr, DO_block_ptr, L,
+            offs_n, offs_m_base, lo, diag_end, qk_scale, N_CTX, P_SEQ,
+            BLOCK_M=BLOCK_M, MASK_CAUSAL=True, DIVISIBLE_M=DIVISIBLE_M,
+            PRECISION=PRECISION,
+        )
+    else:
+        diag_end = lo
+    # only the last q block can be partial, it is peeled off so that the
+    # other blocks skip the masking of the tail of q
+    m_full = N_CTX // BLOCK_M * BLOCK_M
+    dk, dv, QT_block_ptr, O_block_ptr, DO_block_ptr = _bwd_kv_inner(
+        dk, dv, k, v, QT_block_ptr, O_block_ptr, DO_block_ptr, L,
+        offs_n, offs_m_base, diag_end, m_full, qk_scale, N_CTX, P_SEQ,
+        BLOCK_M=BLOCK_M, MASK_CAUSAL=False, DIVISIBLE_M=True,
+        PRECISION=PRECISION,
+    )
+    if not DIVISIBLE_M:
+        dk, dv, QT_block_ptr, O_block_ptr, DO_block_ptr = _bwd_kv_inner(
+            dk, dv, k, v, QT_block_ptr, O_block_ptr, DO_block_ptr, L,
+            offs_n, offs_m_base, tl.maximum(diag_end, m_full), N_CTX, qk_scale, N_CTX, P_SEQ,
+            BLOCK_M=BLOCK_M, MASK_CAUSAL=False, DIVISIBLE_M=False,
+            PRECISION=PRECISION,
+        )
+
+    dk *= sm_scale
+    if DIVISIBLE_N:
+        tl.store(DK_block_ptr, dk.to(input_dtype), cache_modifier=".cs") # (BLOCK_N, BLOCK_DMODEL)
+        tl.store(DV_block_ptr, dv.to(input_dtype), cache_modifier=".cs") # (BLOCK_N, BLOCK_DMODEL,)
+    else:
+        tl.store(DK_block_ptr, dk.to(input_dtype), boundary_check=(0,), cache_modifier=".cs") # (BLOCK_N, BLOCK_DMODEL)
+        tl.store(DV_block_ptr, dv.to(input_dtype), boundary_check=(0,), cache_modifier=".cs") # (BLOCK_N, BLOCK_DMODEL,)
+
+
+@triton.jit
+def _bwd_kv_inner(
+    dk, dv, k, v, QT_block_ptr, O_block_ptr, DO_block_ptr, L,
+    offs_n, offs_m_base, lo, hi, qk_scale, N_CTX, P_SEQ,
+    BLOCK_M: tl.constexpr, MASK_CAUSAL: tl.constexpr, DIVISIBLE_M: tl.constexpr,
+    PRECISION: tl.constexpr,
+):
+    input_dtype = k.dtype
+    for start_m in range(lo, hi, BLOCK_M):
         start_m = tl.multiple_of(start_m, BLOCK_M)
         offs_m = start_m + offs_m_base
-        causal_mask = (P_SEQ + offs_m[:, None]) >= (offs_n[None, :]) # (BLOCK_M, BLOCK_N)
+        causal_mask = (P_SEQ + offs_m[None, :]) >= (offs_n[:, None]) # (BLOCK_N, BLOCK_M)
 
         # load q1, k1, q2, k2, v, do on-chip
         if DIVISIBLE_M:
-            q = tl.load(q_ptrs)
+            qT = tl.load(QT_block_ptr)
         else:
             mask_m = offs_m < N_CTX
-            valid_mask = mask_m[:, None] # & mask_n
-            q = tl.load(q_ptrs, mask=mask_m[:, None])
+            valid_mask = mask_m[None, :] # & mask_n
+            qT = tl.load(QT_block_ptr, boundary_check=(1,), padding_option="zero")
         # recompute p = softmax(qk * sm_scale, dim=-1)
-        s = tl.zeros([BLOCK_M, BLOCK_N], dtype=tl.float32)
-        s += tl.dot(q, tl.trans(k))
+        # qk_scale is folded into q exactly as in the forward kernel, so that
+        # s rounds the same way as when L was computed
+        qT_scaled = (qT.to(tl.float32) * qk_scale).to(input_dtype)
+        sT = tl.dot(k, qT_scaled, input_precision=PRECISION) # (BLOCK_N, BLOCK_M)
 
         # NOTE: since softmax in backward is pointwise, the normalizer has been saved in fwd)
         # So masking on s is not needed.
@@ -489,77 +677,86 @@ def _bwd_kv_kernel(
 
         # -- recompute p ---
         if DIVISIBLE_M:
-            l = tl.load(L + offs_m)
+            l = tl.load(L + offs_m, cache_modifier=".ca")
         else:
-            l = tl.load(L + offs_m, mask=mask_m)
-        p = tl.math.exp2(s * qk_scale - l[:, None] * log2e) # (BLOCK_M, BLOCK_N)
+            l = tl.load(L + offs_m, mask=mask_m, cache_modifier=".ca")
+        pT = tl.math.exp2(sT - l[None, :]) # (BLOCK_N, BLOCK_M)
 
         if not DIVISIBLE_M:
-            p = tl.where(valid_mask, p, 0.0)
-        if CAUSAL:
-            p = tl.where(causal_mask, p, 0.0)
+            pT = tl.where(valid_mask, pT, 0.0)
+        if MASK_CAUSAL:
+            pT = tl.where(causal_mask, pT, 0.0)
 
         # compute dv = dot(p, do)
+        # every kv program of a (batch, head) walks all of do, like q and o, so
+        # it keeps the default caching here, unlike in the dq kernel
         if DIVISIBLE_M:
-            do = tl.load(do_ptrs)
+            do = tl.load(DO_block_ptr)
         else:
-            do = tl.load(do_ptrs, mask=mask_m[:, None]) # (BLOCK_M, BLOCK_DMODEL)
-        dv += tl.dot(tl.trans(p.to(do.dtype)), do) # (BLOCK_N, BLOCK_DMODEL)  # still correct
+            do = tl.load(DO_block_ptr, boundary_check=(0,), padding_option="zero") # (BLOCK_M, BLOCK_DMODEL)
+        dv = tl.dot(pT.to(do.dtype), do, acc=dv, input_precision=PRECISION) # (BLOCK_N, BLOCK_DMODEL)  # still correct
 
-        # compute dp = dot(v, do)
+        # compute delta = rowsum(o * do) in place of a preprocessing kernel
         if DIVISIBLE_M:
-            delta = tl.load(D + offs_m)
+            o = tl.load(O_block_ptr)
         else:
-            delta = tl.load(D + offs_m, mask=mask_m)
-        dp = tl.zeros([BLOCK_M, BLOCK_N], dtype=tl.float32)
-        dp += tl.dot(do, tl.trans(v))
+            o = tl.load(O_block_ptr, boundary_check=(0,), padding_option="zero")
+        delta = tl.sum(o.to(tl.float32) * do.to(tl.float32), axis=1)
+
+        # compute dp = dot(v, do)
+        dpT = tl.dot(v, tl.trans(do), input_precision=PRECISION) # (BLOCK_N, BLOCK_M)
 
         # compute ds = p * (dp - delta[:, None])
-        ds = p * (dp - delta[:, None]) # (BLOCK_M, BLOCK_N)
+        dsT = pT * (dpT - delta[None, :]) # (BLOCK_N, BLOCK_M)
 
         if not DIVISIBLE_M:
-            ds = tl.where(valid_mask, ds, 0.0)
-        if CAUSAL:
-            ds = tl.where(causal_mask, ds, 0.0)
-        ds = ds.to(input_dtype)
+            dsT = tl.where(valid_mask, dsT, 0.0)
+        if MASK_CAUSAL:
+            dsT = tl.where(causal_mask, dsT, 0.0)
+        dsT = dsT.to(input_dtype)
 
         # compute dk = dot(ds.T, q) masking
-        dk += tl.dot(tl.trans(ds), q)
+        dk = tl.dot(dsT, tl.trans(qT), acc=dk, input_precision=PRECISION)
 
         # increment pointers
-        q_ptrs += BLOCK_M * stride_qm
-        do_ptrs += BLOCK_M * stride_dom
-
-    dk *= sm_scale
-    if DIVISIBLE_N:
-        tl.store(dk_ptrs, dk.to(input_dtype)) # (BLOCK_N, BLOCK_DMODEL)
-        tl.store(dv_ptrs, dv.to(input_dtype)) # (BLOCK_N, BLOCK_DMODEL,)
-    else:
-        tl.store(dk_ptrs, dk.to(input_dtype), mask=mask_n[:, None]) # (BLOCK_N, BLOCK_DMODEL)
-        tl.store(dv_ptrs, dv.to(input_dtype), mask=mask_n[:, None]) # (BLOCK_N, BLOCK_DMODEL,)
-
-
+        QT_block_ptr = tl.advance(QT_block_ptr, (0, BLOCK_M))
+        O_block_ptr = tl.advance(O_block_ptr, (BLOCK_M, 0))
+        DO_block_ptr = tl.advance(DO_block_ptr, (BLOCK_M, 0))
+    return dk, dv, QT_block_ptr, O_block_ptr, DO_block_ptr
+
+
+@triton.autotune(
+    configs=[
+        triton.Config({"BLOCK_M": m, "BLOCK_N": n, "GROUP_H": g}, num_warps=w, num_stages=s)
+        for m, n, w, s, g in _bwd_q_configs
+    ],
+    key=["N_CTX", "P_SEQ", "BLOCK_DMODEL", "CAUSAL"],
+)
+@triton.heuristics({
+    "DIVISIBLE_M": lambda args: args["N_CTX"] % args["BLOCK_M"] == 0,
+    "DIVISIBLE_N": lambda args: (args["N_CTX"] + args["P_SEQ"]) % args["BLOCK_N"] == 0,
+})
 @triton.jit
 def _bwd_q_kernel(
-    Q, K, V, sm_scale, DO,
+    Q, K, V, sm_scale, O, DO,
     DQ,
     L,
-    D,
     stride_qz, stride_qh, stride_qm, stride_qk,
     stride_kz, stride_kh, stride_kn, stride_kk,
     stride_vz, stride_vh, stride_vn, stride_vk,
+    stride_oz, stride_oh, stride_om, stride_ok,
     stride_doz, stride_doh, stride_dom, stride_dok,
     stride_dqz, stride_dqh, stride_dqm, stride_dqk,
     Z, H, N_CTX, P_SEQ, 
     BLOCK_M: tl.constexpr, BLOCK_DMODEL: tl.constexpr, BLOCK_N: tl.constexpr,
     CAUSAL: tl.constexpr, 
     DIVISIBLE_M: tl.constexpr, DIVISIBLE_N: tl.constexpr,
+    GROUP_H: tl.constexpr = 1, PRECISION: tl.constexpr = "tf32",
 ):
     input_dtype = Q.dtype.element_ty
     # -- grid id --
     start_m = tl.program_id(0)
-    off_h = tl.program_id(1)
-    off_z = tl.program_id(2)
+    off_h, off_z = _swizzle_hz(H, Z, GROUP_H)
     
     # scale sm_scale by log_2(e) and use
     # 2^x instead of exp in the loop because CSE and LICM
@@ -571,8 +768,8 @@ def _bwd_q_kernel(
     Q += off_z * stride_qz + off_h * stride_qh
     K += off_z * stride_kz + off_h * stride_kh
     V += off_z * stride_vz + off_h * stride_vh
+    O += off_z * stride_oz + off_h * stride_oh
     DO += off_z * stride_doz + off_h * stride_doh
-    D += (off_z * H + off_h) * N_CTX
     L += (off_z * H + off_h) * N_CTX
 
     # offset pointers for batch/head
@@ -580,61 +777,128 @@ def _bwd_q_kernel(
 
     offs_m = start_m * BLOCK_M + tl.arange(0, BLOCK_M)
     offs_n_base = tl.arange(0, BLOCK_N)
-    offs_n_init = offs_n_base
-    offs_k = tl.arange(0, BLOCK_DMODEL)
 
     # initialize pointers to value-like data 
-    q_ptrs = Q + (offs_m[:, None] * stride_qm + offs_k[None, :] * stride_qk) # (BLOCK_M, BLOCK_DMODEL)
-    k_ptrs = K + (offs_n_init[:, None] * stride_kn + offs_k[None, :] * stride_kk) # (BLOCK_N, BLOCK_DMODEL)
-    v_ptrs = V + (offs_n_init[:, None] * stride_vn + offs_k[None, :] * stride_vk) # (BLOCK_N, BLOCK_DMODEL)
-
-    dq_ptrs = DQ + (offs_m[:, None] * stride_dqm + offs_k[None, :] * stride_dqk) # (BLOCK_M, BLOCK_DMODEL)
-    do_ptrs = DO + (offs_m[:, None] * stride_dom + offs_k[None, :] * stride_dok) # (BLOCK_M, BLOCK_DMODEL)
+    Q_block_ptr = tl.make_block_ptr(
+        base=Q, shape=(N_CTX, BLOCK_DMODEL), strides=(stride_qm, stride_qk),
+        offsets=(start_m * BLOCK_M, 0), block_shape=(BLOCK_M, BLOCK_DMODEL), order=(1, 0),
+    )
+    K_block_ptr = tl.make_block_ptr(
+        base=K, shape=(N_CTX + P_SEQ, BLOCK_DMODEL), strides=(stride_kn, stride_kk),
+        offsets=(0, 0), block_shape=(BLOCK_N, BLOCK_DMODEL), order=(1, 0),
+    )
+    VT_block_ptr = tl.make_block_ptr(
+        base=V, shape=(BLOCK_DMODEL, N_CTX + P_SEQ), strides=(stride_vk, stride_vn),
+        offsets=(0, 0), block_shape=(BLOCK_DMODEL, BLOCK_N), order=(0, 1),
+    )
+
+    O_block_ptr = tl.make_block_ptr(
+        base=O, shape=(N_CTX, BLOCK_DMODEL), strides=(stride_om, stride_ok),
+        offsets=(start_m * BLOCK_M, 0), block_shape=(BLOCK_M, BLOCK_DMODEL), order=(1, 0),
+    )
+    DQ_block_ptr = tl.make_block_ptr(
+        base=DQ, shape=(N_CTX, BLOCK_DMODEL), strides=(stride_dqm, stride_dqk),
+        offsets=(start_m * BLOCK_M, 0), block_shape=(BLOCK_M, BLOCK_DMODEL), order=(1, 0),
+    )
+    DO_block_ptr = tl.make_block_ptr(
+        base=DO, shape=(N_CTX, BLOCK_DMODEL), strides=(stride_dom, stride_dok),
+        offsets=(start_m * BLOCK_M, 0), block_shape=(BLOCK_M, BLOCK_DMODEL), order=(1, 0),
+    )
 
     # pointer to row-wise quantities in value-like data
-    d_ptrs = D + offs_m
     l_ptrs = L + offs_m
 
     # load q: it will stay in SRAM throughout
     if DIVISIBLE_M:
-        q = tl.load(q_ptrs)
-        do = tl.load(do_ptrs)
-        delta = tl.load(d_ptrs)
-        l = tl.load(l_ptrs)
+        q = tl.load(Q_block_ptr)
+        o = tl.load(O_block_ptr)
+        do = tl.load(DO_block_ptr, cache_modifier=".cs")
+        l = tl.load(l_ptrs, cache_modifier=".ca")
     else:
         mask_m = offs_m < N_CTX
-        q = tl.load(q_ptrs, mask=mask_m[:, None])
-        do = tl.load(do_ptrs, mask=mask_m[:, None])
-        delta = tl.load(d_ptrs, mask=mask_m)
-        l = tl.load(l_ptrs, mask=mask_m)
+        q = tl.load(Q_block_ptr, boundary_check=(0,), padding_option="zero")
+        o = tl.load(O_block_ptr, boundary_check=(0,), padding_option="zero")
+        do = tl.load(DO_block_ptr, boundary_check=(0,), padding_option="zero", cache_modifier=".cs")
+        l = tl.load(l_ptrs, mask=mask_m, cache_modifier=".ca")
+    # fold qk_scale into q once, s is then recomputed in log2 units
+    q = (q.to(tl.float32) * qk_scale).to(input_dtype)
+
+    # compute delta = rowsum(o * do) in place of a preprocessing kernel
+    delta = tl.sum(o.to(tl.float32) * do.to(tl.float32), axis=1)
 
     # initialize dq 
     dq = tl.zeros([BLOCK_M, BLOCK_DMODEL], dtype=tl.float32)
 
     # loop over k, v and update accumulator
-    hi = P_SEQ + (start_m + 1) * BLOCK_M if CAUSAL else N_CTX + P_SEQ
+    if CAUSAL:
+        hi = tl.minimum(P_SEQ + (start_m + 1) * BLOCK_M, N_CTX + P_SEQ)
+        # k blocks left of the diagonal are fully visible to this q block, so
+        # they need neither causal masking nor masking of the tail of k
+        diag_start = (P_SEQ + start_m * BLOCK_M) // BLOCK_N * BLOCK_N
+        dq, K_block_ptr, VT_block_ptr = _bwd_q_inner(
+            dq, q, do, l, delta, K_block_ptr, VT_block_ptr,
+            offs_m, offs_n_base, 0, diag_start, N_CTX, P_SEQ,
+            BLOCK_N=BLOCK_N, MASK_CAUSAL=False, DIVISIBLE_N=True,
+            PRECISION=PRECISION,
+        )
+        dq, K_block_ptr, VT_block_ptr = _bwd_q_inner(
+            dq, q, do, l, delta, K_block_ptr, VT_block_ptr,
+            offs_m, offs_n_base, diag_start, hi, N_CTX, P_SEQ,
+            BLOCK_N=BLOCK_N, MASK_CAUSAL=True, DIVISIBLE_N=DIVISIBLE_N,
+            PRECISION=PRECISION,
+        )
+    else:
+        # only the last k block can be partial, it is peeled off so that the
+        # other blocks skip the masking of the tail of k
+        n_full = (N_CTX + P_SEQ) // BLOCK_N * BLOCK_N
+        dq, K_block_ptr, VT_block_ptr = _bwd_q_inner(
+            dq, q, do, l, delta, K_block_ptr, VT_block_ptr,
+            offs_m, offs_n_base, 0, n_full, N_CTX, P_SEQ,
+            BLOCK_N=BLOCK_N, MASK_CAUSAL=False, DIVISIBLE_N=True,
+            PRECISION=PRECISION,
+        )
+        if not DIVISIBLE_N:
+            dq, K_block_ptr, VT_block_ptr = _bwd_q_inner(
+                dq, q, do, l, delta, K_block_ptr, VT_block_ptr,
+                offs_m, offs_n_base, n_full, N_CTX + P_SEQ, N_CTX, P_SEQ,
+                BLOCK_N=BLOCK_N, MASK_CAUSAL=False, DIVISIBLE_N=False,
+                PRECISION=PRECISION,
+            )
+
+    dq *= sm_scale
+    if DIVISIBLE_M:
+        tl.store(DQ_block_ptr, dq.to(input_dtype), cache_modifier=".cs")
+    else:
+        tl.store(DQ_block_ptr, dq.to(input_dtype), boundary_check=(0,), cache_modifier=".cs")
 
-    # loop over a row
-    for start_n in range(0, hi, BLOCK_N):
+
+@triton.jit
+def _bwd_q_inner(
+    dq, q, do, l, delta, K_block_ptr, VT_block_ptr,
+    offs_m, offs_n_base, lo, hi, N_CTX, P_SEQ,
+    BLOCK_N: tl.constexpr, MASK_CAUSAL: tl.constexpr, DIVISIBLE_N: tl.constexpr,
+    PRECISION: tl.constexpr,
+):
+    input_dtype = q.dtype
+    for start_n in range(lo, hi, BLOCK_N):
         offs_n = start_n + offs_n_base
         
         # load k1, k2, v on chip
         if DIVISIBLE_N:
-            v = tl.load(v_ptrs)
-            k = tl.load(k_ptrs)
+            vT = tl.load(VT_block_ptr)
+            k = tl.load(K_block_ptr)
         else:
             mask_n = offs_n < (N_CTX + P_SEQ)
-            v = tl.load(v_ptrs, mask=mask_n[:, None])
-            k = tl.load(k_ptrs, mask=mask_n[:, None])
+            vT = tl.load(VT_block_ptr, boundary_check=(1,), padding_option="zero")
+            k = tl.load(K_block_ptr, boundary_check=(0,), padding_option="zero")
 
 
         # recompute p = softmax(qk * sm_scale, dim=-1)
         if not DIVISIBLE_N:
             valid_mask = mask_n # & mask_m[:, None] 
-        if CAUSAL:
+        if MASK_CAUSAL:
             causal_mask = (P_SEQ + offs_m[:, None]) >= (offs_n[None, :]) # (BLOCK_M, BLOCK_N)
-        s = tl.zeros([BLOCK_M, BLOCK_N], dtype=tl.float32)
-        s += tl.dot(q, tl.trans(k))
+        s = tl.dot(q, tl.trans(k), input_precision=PRECISION)
 
         # NOTE: since softmax in backward is pointwise, the normalizer has been saved in fwd)
         # So masking on s is not needed.
@@ -642,11 +906,10 @@ def _bwd_q_kernel(
         #     s = tl.where(causal_mask & valid_mask, s, float("-inf"))
         # else:
         #     s = tl.where(valid_mask, s, float("-inf"))
-        p = tl.math.exp2(s * qk_scale - l[:, None] * log2e) # (BLOCK_M, BLOCK_N)
+        p = tl.math.exp2(s - l[:, None]) # (BLOCK_M, BLOCK_N)
 
         # compute dp = dot(v, do)
-        dp = tl.zeros([BLOCK_M, BLOCK_N], dtype=tl.float32)
-        dp += tl.dot(do.to(input_dtype), tl.trans(v))
+        dp = tl.dot(do.to(input_dtype), vT, input_precision=PRECISION)
         # no need to mask dp
         # if CAUSAL:
         #     dp = tl.where(causal_mask & valid_mask, dp, 0.0)
@@ -660,17 +923,12 @@ def _bwd_q_kernel(
         # mask ds to ensure no small values
         if not DIVISIBLE_N:
             ds = tl.where(valid_mask, ds, 0.0)
-        if CAUSAL:
+        if MASK_CAUSAL:
             ds = tl.where(causal_mask, ds, 0.0)
 
-        dq += tl.dot(ds.to(input_dtype), k)
+        dq = tl.dot(ds.to(input_dtype), k, acc=dq, input_precision=PRECISION)
 
         # increment pointers
-        k_ptrs += BLOCK_N * stride_kn
-        v_ptrs += BLOCK_N * stride_vn
-    
-    dq *= sm_scale
-    if DIVISIBLE_M:
-        tl.store(dq_ptrs, dq.to(input_dtype))
-    else:
-        tl.store(dq_ptrs, dq.to(input_dtype), mask=mask_m[:, None])
+        K_block_ptr = tl.advance(K_block_ptr, (BLOCK_N, 0))
+        VT_block_ptr = tl.advance(VT_block_ptr, (0, BLOCK_N))
+    return dq, K_block_ptr, VT_block_ptr
@@ -0,0 +1,48 @@
+import ctypes
+import os
+
+import pytest
+
+
+def pytest_addoption(parser):
+    parser.addoption("--runslow", action="store_true", default=False, help="run the full parameter matrix")
+
+def pytest_configure(config):
+    config.addinivalue_line("markers", "slow: part of the full parameter matrix, needs --runslow to run")
+
+    # give each pytest-xdist worker its own gpu. This has to happen before
+    # cuda is initialized in the worker, so it is done here and not in a fixture
+    worker = os.environ.get("PYTEST_XDIST_WORKER")
+    if worker is None:
+        return
+    devices = _visible_devices()
+    if devices:
+        os.environ["CUDA_VISIBLE_DEVICES"] = devices[int(worker[2:]) % len(devices)]
+
+def _visible_devices():
+    # torch.cuda is not asked: older torch caches its device count, so a count
+    # taken before CUDA_VISIBLE_DEVICES is set would make the pinning a no-op
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        return [device for device in visible.split(",") if device]
+    try:
+        nvml = ctypes.CDLL("libnvidia-ml.so.1")
+    except OSError:
+        return []
+    if nvml.nvmlInit_v2() != 0:
+        return []
+    try:
+        count = ctypes.c_uint()
+        if nvml.nvmlDeviceGetCount_v2(ctypes.byref(count)) != 0:
+            return []
+    finally:
+        nvml.nvmlShutdown()
+    return [str(i) for i in range(count.value)]
+
+def pytest_collection_modifyitems(config, items):
+    if config.getoption("--runslow"):
+        return
+    skip_slow = pytest.mark.skip(reason="needs --runslow to run")
+    for item in items:
+        if "slow" in item.keywords:
+            item.add_marker(skip_slow)
@@ -1,103 +1,359 @@
+import inspect
+import math
+import os
+import zlib
+
 import torch
 import pytest
+import triton
 
 import flag_attn
 
 torch.random.manual_seed(10086)
 
+REPORT = bool(int(os.getenv("FLAG_ATTN_REPORT", "0")))
+
+pytestmark = pytest.mark.skipif(not torch.cuda.is_available(), reason="requires a cuda device")
+
 def max_diff(a, b):
-    return (a - b).abs().max().item()
+    # kept on device, the caller decides when to sync
+    return (a - b).abs().amax()
+
+def assert_close(actual, expected, torch_max_diff):
+    # the kernel may be at most twice as far from the upcast reference as the
+    # un-upcast torch path is
+    torch.testing.assert_close(actual, expected, rtol=0, atol=2 * torch_max_diff + 1e-5, check_dtype=False)
 
 def zero_percent(a, b):
     diff = (a - b).abs()
-    num_non_zeros = diff.nonzero().shape[0]
-    return (1.0 - num_non_zeros/ diff.numel()) * 100.0
+    num_non_zeros = diff.count_nonzero()
+    return (1.0 - num_non_zeros / diff.numel()) * 100.0
 
 def report(name, actual, expected):
+    if not REPORT:
+        return
     print(f"{name}: \tmax_difference: {max_diff(actual, expected):0.6f}\tzero_diff elements: {zero_percent(actual, expected):0.3f}%")
 
+def bf16_supported(device_id):
+    # pre-ampere gpus have no bf16 tensor cores, the emulated path is slow
+    # and not what the tolerances are meant for
+    return torch.cuda.get_device_capability(device_id)[0] >= 8
 
-@pytest.mark.parametrize('device_id', list(range(torch.cuda.device_count())))
-@pytest.mark.parametrize('scale', [1.0, 2.0, 3.0, 4.0])
-@pytest.mark.parametrize('B, H, T, D, P_SEQ', [
-    (2, 4, 512, 128, 100),
-    (2, 4, 1024, 64, 10), 
+def skip_unsupported(dtype, device_id):
+    if dtype is torch.bfloat16 and not bf16_supported(device_id):
+        pytest.skip("bf16 requires sm_80+")
+
+
+@pytest.fixture(scope="module", autouse=True)
+def _cleanup():
+    # release the cached blocks once the module is done, emptying the cache
+    # after every case would only make the allocator start over
+    yield
+    torch.cuda.empty_cache()
+
+@pytest.fixture
+def device_id():
+    # the kernels have no multi-gpu logic, so the cases run on the first
+    # visible device. Under pytest-xdist each worker sees a different gpu (see
+    # tests/conftest.py), so `pytest -n <num_gpus>` spreads the cases over all of them
+    return 0
+
+@pytest.fixture(scope="module")
+def ref_cache():
+    # inputs and upcast references do not depend on dtype, so they are made
+    # once in fp32 and shared by the fp16 and bf16 variants of a case
+    return {}
+
+def to_layout(x, stride_order):
+    # the same values, laid out in memory as (B, T, H, D) for BTHD
+    if stride_order == "BTHD":
+        return x.transpose(1, 2).contiguous().transpose(1, 2)
+    return x
+
+def round_to_16bit(x):
+    # values exact in bf16 are exact in fp16 as well (short of fp16 underflow),
+    # so the fp32 inputs equal their fp16 and bf16 casts and the references made
+    # from them carry no input quantization error
+    return x.to(torch.bfloat16).float()
+
+def get_normal(ref_cache, name, shape, device_id):
+    # one standard normal draw per tensor and shape, the inputs of every scale
+    # are multiples of it, so changing the scale costs no new sampling. Each
+    # draw is seeded from its own name and shape, so its values (and the cached
+    # tolerances computed from them) do not depend on which cases ran before
+    key = ("normal", name, shape, device_id)
+    if key not in ref_cache:
+        seed = zlib.crc32(f"{name}-{shape}".encode())
+        gen = torch.Generator(device=f"cuda:{device_id}").manual_seed(seed)
+        ref_cache[key] = round_to_16bit(torch.empty(shape, device=f"cuda:{device_id}").normal_(generator=gen))
+    return ref_cache[key]
+
+def get_inputs(ref_cache, B, H, T, D, P_SEQ, stride_order, scale, device_id):
+    # only the BHTD tensors are sampled, the BTHD ones are copies of them, so
+    # the two layouts see the same values and share the references
+    key = ("inputs", B, H, T, D, P_SEQ, scale, device_id)
+    if key not in ref_cache:
+        # scales that are not powers of two take the draws off the bf16 grid
+        q = round_to_16bit(get_normal(ref_cache, "q", (B, H, T, D), device_id) * scale)
+        k = round_to_16bit(get_normal(ref_cache, "k", (B, H, T + P_SEQ, D), device_id) * scale)
+        v = round_to_16bit(get_normal(ref_cache, "v", (B, H, T + P_SEQ, D), device_id) * scale)
+        ref_cache[key] = (q, k, v)
+    if stride_order == "BHTD":
+        return ref_cache[key]
+    layout_key = key + (stride_order,)
+    if layout_key not in ref_cache:
+        ref_cache[layout_key] = tuple(to_layout(x, stride_order) for x in ref_cache[key])
+    return ref_cache[layout_key]
+
+def get_o_ref(ref_cache, B, H, T, D, P_SEQ, causal, scale, device_id):
+    key = ("o", B, H, T, D, P_SEQ, causal, scale, device_id)
+    if key not in ref_cache:
+        q, k, v = get_inputs(ref_cache, B, H, T, D, P_SEQ, "BHTD", scale, device_id)
+        ref_cache[key] = flag_attn.testing.flash_attention(q, k, v, causal, upcast=True)
+    return ref_cache[key]
+
+def get_do(ref_cache, B, H, T, D, stride_order, device_id):
+    do = get_normal(ref_cache, "do", (B, H, T, D), device_id)
+    if stride_order == "BHTD":
+        return do
+    key = ("do", B, H, T, D, stride_order, device_id)
+    if key not in ref_cache:
+        ref_cache[key] = to_layout(do, stride_order)
+    return ref_cache[key]
+
+def get_grad_refs(ref_cache, B, H, T, D, P_SEQ, causal, scale, device_id):
+    key = ("grad", B, H, T, D, P_SEQ, causal, scale, device_id)
+    if key not in ref_cache:
+        q, k, v = get_inputs(ref_cache, B, H, T, D, P_SEQ, "BHTD", scale, device_id)
+        do = get_do(ref_cache, B, H, T, D, "BHTD", device_id)
+        # the cached inputs are shared, so the graph is built on detached leaves
+        q, k, v = q.detach().requires_grad_(), k.detach().requires_grad_(), v.detach().requires_grad_()
+        o = flag_attn.testing.flash_attention(q, k, v, causal, upcast=True)
+        ref_cache[key] = torch.autograd.grad(o, (q, k, v), do, retain_graph=False)
+        ref_cache.setdefault(("o", B, H, T, D, P_SEQ, causal, scale, device_id), o.detach())
+    return ref_cache[key]
+
+def make_leaf(x, dtype):
+    # a new autograd leaf in dtype, in x's memory layout. The copy is forced
+    # so that requires_grad_ can never land on a cached tensor
+    leaf = x.to(dtype, copy=True).requires_grad_()
+    assert leaf.is_leaf
+    return leaf
+
+
+def _source_hash(*objs):
+    return f"{zlib.crc32(''.join(inspect.getsource(obj) for obj in objs).encode()):08x}"
+
+# the code that makes the inputs and the torch path, the cached max differences
+# are stale once it changes
+TOLERANCE_SOURCE_HASH = _source_hash(
+    round_to_16bit, get_normal, get_inputs, get_do, flag_attn.testing.flash_attention)
+
+def torch_max_diffs(request, name, key, compute):
+    # the max differences of the un-upcast torch path set the tolerances. They
+    # only depend on the case, the torch build and the code producing them, so
+    # they are kept in pytest's cache between runs and the torch path is run only
+    # when they are missing. There is no cache under -p no:cacheprovider
+    cache = getattr(request.config, "cache", None)
+    key = tuple(key) + (torch.__version__, torch.version.cuda, TOLERANCE_SOURCE_HASH)
+    cache_key = f"flag_attn/torch_max_diff/{name}/" + "-".join(str(x) for x in key)
+    diffs = cache.get(cache_key, None) if cache is not None else None
+    if diffs is None:
+        # one sync for all of them
+        diffs = torch.stack(compute()).tolist()
+        if cache is not None:
+            cache.set(cache_key, diffs)
+    return diffs
+
+
+def case(B, H, T, D, P_SEQ, causal, stride_order, dtype, scale, marks=(), prefix=None):
+    id = "-".join(([prefix] if prefix else []) + [
+        f"{B}x{H}x{T}x{D}", f"p{P_SEQ}", "causal" if causal else "noncausal",
+        stride_order, str(dtype).split(".")[-1], f"s{scale:g}",
+    ])
+    return pytest.param(B, H, T, D, P_SEQ, causal, stride_order, dtype, scale, marks=marks, id=id)
+
+def full_matrix(shapes):
+    # the complete cross product, only collected with --runslow
+    return [
+        case(B, H, T, D, P_SEQ, causal, stride_order, dtype, scale, marks=pytest.mark.slow, prefix="matrix")
+        for B, H, T, D, P_SEQ in shapes
+        for causal in [True, False]
+        for stride_order in ['BHTD', 'BTHD']
+        for dtype in [torch.float16, torch.bfloat16]
+        for scale in [1.0, 2.0, 3.0, 4.0]
+    ]
+
+CASE_ARGS = "B, H, T, D, P_SEQ, causal, stride_order, dtype, scale"
+
+# each shape is hit once, and every (dtype, causal) pair, stride order and
+# scale extreme at least once. The backward cases check o as well, so the
+# forward-only cases keep to the shapes the backward ones do not cover. fp32
+# is not in the full matrix, one case each checks the full precision dots
+FWD_SHAPES = [
+    (2, 4, 1024, 64, 10),
     (2, 4, 2048, 32, 0),
-    (2, 4, 4096, 16, 0),
     (1, 2, 8192, 16, 10),
     (1, 2, 8192, 32, 0),
-])
-@pytest.mark.parametrize('causal', [True, False])
-@pytest.mark.parametrize('dtype', [torch.float16, torch.bfloat16])
-@pytest.mark.parametrize('stride_order', ['BHTD', 'BTHD'])
-def test_attention_fwd(B, H, T, D, P_SEQ, causal, stride_order, dtype, scale, device_id):
-    device = f"cuda:{device_id}"
-    if stride_order == "BHTD":
-        q = torch.empty((B, H, T, D), dtype=dtype, device=device).normal_(mean=0., std=scale)
-        k = torch.empty((B, H, T + P_SEQ, D), dtype=dtype, device=device).normal_(mean=0., std=scale)
-        v = torch.empty((B, H, T + P_SEQ, D), dtype=dtype, device=device).normal_(mean=0., std=scale)
-    else:
-        q = torch.empty((B, T, H, D), dtype=dtype, device=device).normal_(mean=0., std=scale).transpose(1, 2)
-        k = torch.empty((B, T + P_SEQ, H, D), dtype=dtype, device=device).normal_(mean=0., std=scale).transpose(1, 2)
-        v = torch.empty((B, T + P_SEQ, H, D), dtype=dtype, device=device).normal_(mean=0., std=scale).transpose(1, 2)
-
-    o_ref = flag_attn.testing.flash_attention(q, k, v, causal, upcast=True)
-    o_torch = flag_attn.testing.flash_attention(q, k, v, causal, upcast=False)
-    o_hyp = flag_attn.flash_attention(q, k, v, causal)
-    
-    torch_max_diff = max_diff(o_torch, o_ref)
-    triton_max_diff = max_diff(o_hyp, o_ref)
-    report("o hyp", o_hyp, o_ref)
-    report("o torch", o_hyp, o_ref)
-    assert triton_max_diff <= 2 * torch_max_diff + 1e-5
+]
+FWD_CASES = [
+    case(2, 4, 1024, 64, 10, False, 'BTHD', torch.bfloat16, 4.0),
+    case(2, 4, 2048, 32, 0, True, 'BHTD', torch.bfloat16, 4.0),
+    case(1, 2, 8192, 16, 10, True, 'BTHD', torch.float16, 4.0),
+    case(1, 2, 8192, 32, 0, False, 'BHTD', torch.float16, 1.0),
+    case(2, 4, 1024, 64, 10, True, 'BHTD', torch.float32, 1.0),
+]
 
-
-@pytest.mark.parametrize('device_id', list(range(torch.cuda.device_count())))
-@pytest.mark.parametrize('scale', [1.0, 2.0, 3.0, 4.0])
-@pytest.mark.parametrize('B, H, T, D, P_SEQ', [
+BWD_SHAPES = [
     (2, 4, 512, 128, 100),
     (2, 4, 1024, 64, 0),
     (2, 4, 2048, 32, 10),
     (2, 4, 4096, 16, 0),
     (1, 2, 8192, 16, 0),
     (2, 2, 8192, 32, 0),
-])
-@pytest.mark.parametrize('causal', [True, False])
-@pytest.mark.parametrize('dtype', [torch.float16, torch.bfloat16])
-@pytest.mark.parametrize('stride_order', ['BHTD', 'BTHD'])
-def test_attention_fwd_bwd(B, H, T, D, P_SEQ, causal, stride_order, dtype, scale, device_id):
-    device = f"cuda:{device_id}"
-    if stride_order == "BHTD":
-        q = torch.empty((B, H, T, D), dtype=dtype, device=device).normal_(mean=0., std=scale).requires_grad_()
-        k = torch.empty((B, H, T + P_SEQ, D), dtype=dtype, device=device).normal_(mean=0., std=scale).requires_grad_()
-        v = torch.empty((B, H, T + P_SEQ, D), dtype=dtype, device=device).normal_(mean=0., std=scale).requires_grad_()
-        do = torch.randn((B, H, T, D), dtype=dtype, device=device)
-    else:
-        q = torch.empty((B, T, H, D), dtype=dtype, device=device).normal_(mean=0., std=scale).transpose(1, 2).requires_grad_()
-        k = torch.empty((B, T + P_SEQ, H, D), dtype=dtype, device=device).normal_(mean=0., std=scale).transpose(1, 2).requires_grad_()
-        v = torch.empty((B, T + P_SEQ, H, D), dtype=dtype, device=device).normal_(mean=0., std=scale).transpose(1, 2).requires_grad_()
-        do = torch.randn((B, T, H, D), dtype=dtype, device=device).transpose(1, 2)
-    
-    o_ref = flag_attn.testing.flash_attention(q, k, v, causal=causal, upcast=True)
-    o_torch = flag_attn.testing.flash_attention(q, k, v, causal=causal, upcast=False)
+]
+BWD_CASES = [
+    case(2, 4, 512, 128, 100, False, 'BTHD', torch.bfloat16, 1.0),
+    case(2, 4, 1024, 64, 0, True, 'BHTD', torch.float16, 4.0),
+    case(2, 4, 2048, 32, 10, True, 'BTHD', torch.bfloat16, 1.0),
+    case(2, 4, 4096, 16, 0, False, 'BHTD', torch.float16, 4.0),
+    case(1, 2, 8192, 16, 0, False, 'BHTD', torch.bfloat16, 4.0),
+    case(2, 2, 8192, 32, 0, True, 'BTHD', torch.float16, 1.0),
+    case(2, 4, 1024, 64, 0, False, 'BTHD', torch.float32, 1.0),
+]
+
+
+@pytest.mark.parametrize(CASE_ARGS, FWD_CASES + full_matrix(FWD_SHAPES))
+def test_attention_fwd(B, H, T, D, P_SEQ, causal, stride_order, dtype, scale, device_id, ref_cache, request):
+    skip_unsupported(dtype, device_id)
+    # the cached inputs are made outside of inference mode, the backward cases
+    # may need them as autograd leaves
+    q, k, v = get_inputs(ref_cache, B, H, T, D, P_SEQ, stride_order, scale, device_id)
+    with torch.inference_mode():
+        q, k, v = q.to(dtype), k.to(dtype), v.to(dtype)
+
+        o_ref = get_o_ref(ref_cache, B, H, T, D, P_SEQ, causal, scale, device_id)
+        # compared in fp32 against the fp32 reference, cast once up front
+        o_hyp = flag_attn.flash_attention(q, k, v, causal).float()
+
+        key = (B, H, T, D, P_SEQ, causal, stride_order, dtype, scale, torch.cuda.get_device_name(device_id))
+        torch_max_diff, = torch_max_diffs(request, "fwd", key, lambda: [
+            max_diff(flag_attn.testing.flash_attention(q, k, v, causal, upcast=False), o_ref)
+        ])
+        report("o hyp", o_hyp, o_ref)
+        assert_close(o_hyp, o_ref, torch_max_diff)
+    del q, k, v, o_hyp
+
+
+# the launcher and the autotuner pick these constexprs per device and key, so
+# some variants are only reached reliably by launching the kernel directly.
+# The kernel defaults match what the launcher passes on ampere and newer
+FWD_VARIANTS = [
+    pytest.param({}, id="defaults"),
+    pytest.param({"USE_DOT_I": True}, id="dot_i"),
+    pytest.param({"GROUP_H": 8}, id="group_h8"),
+    pytest.param({"P_FP16": False}, id="p_fp32"),
+    pytest.param({"USE_TMA": True}, id="tma"),
+]
+
+def launch_fwd(q, k, v, causal, **constexprs):
+    # the forward kernel without the autotuner in front of it
+    B, H, M, D = q.shape
+    P_SEQ = k.shape[2] - M
+    o = torch.empty_like(q)
+    L = torch.empty((B, H, M), device=q.device, dtype=torch.float32)
+    grid = (triton.cdiv(M, constexprs["BLOCK_M"]), H, B)
+    flag_attn.flash._fwd_kernel.fn[grid](
+        q, k, v, 1. / math.sqrt(D),
+        L, o,
+        *q.stride(), *k.stride(), *v.stride(), *o.stride(),
+        B, H, M, P_SEQ,
+        BLOCK_DMODEL=D, IS_CAUSAL=causal, **constexprs,
+    )
+    return o
+
+@pytest.mark.parametrize("constexprs", FWD_VARIANTS)
+def test_attention_fwd_variants(constexprs, device_id, ref_cache, request):
+    # 12 heads, so that GROUP_H=8 leaves a partial group
+    B, H, T, D, P_SEQ, causal, dtype, scale = 2, 12, 500, 64, 10, True, torch.float16, 1.0
+    if constexprs.get("USE_TMA"):
+        if not flag_attn.flash._has_tma(device_id):
+            pytest.skip("TMA requires sm_90+")
+        flag_attn.flash._install_tma_allocator()
+    q, k, v = get_inputs(ref_cache, B, H, T, D, P_SEQ, 'BHTD', scale, device_id)
+    with torch.inference_mode():
+        q, k, v = q.to(dtype), k.to(dtype), v.to(dtype)
+
+        o_ref = get_o_ref(ref_cache, B, H, T, D, P_SEQ, causal, scale, device_id)
+        o_hyp = launch_fwd(
+            q, k, v, causal, BLOCK_M=64, BLOCK_N=64, num_warps=4, num_stages=2, **constexprs,
+        ).float()
+
+        key = (B, H, T, D, P_SEQ, causal, 'BHTD', dtype, scale, torch.cuda.get_device_name(device_id))
+        torch_max_diff, = torch_max_diffs(request, "fwd", key, lambda: [
+            max_diff(flag_attn.testing.flash_attention(q, k, v, causal, upcast=False), o_ref)
+        ])
+        report("o hyp", o_hyp, o_ref)
+        assert_close(o_hyp, o_ref, torch_max_diff)
+    del q, k, v, o_hyp
+
+
+@pytest.mark.parametrize(CASE_ARGS, BWD_CASES + full_matrix(BWD_SHAPES))
+def test_attention_fwd_bwd(B, H, T, D, P_SEQ, causal, stride_order, dtype, scale, device_id, ref_cache, request):
+    skip_unsupported(dtype, device_id)
+    q_f32, k_f32, v_f32 = get_inputs(ref_cache, B, H, T, D, P_SEQ, stride_order, scale, device_id)
+    q, k, v = make_leaf(q_f32, dtype), make_leaf(k_f32, dtype), make_leaf(v_f32, dtype)
+    do = get_do(ref_cache, B, H, T, D, stride_order, device_id).to(dtype)
+
+    gq_ref, gk_ref, gv_ref = get_grad_refs(ref_cache, B, H, T, D, P_SEQ, causal, scale, device_id)
+    o_ref = get_o_ref(ref_cache, B, H, T, D, P_SEQ, causal, scale, device_id)
     o_hyp = flag_attn.flash_attention(q, k, v, causal=causal)
+    gq_hyp, gk_hyp, gv_hyp = torch.autograd.grad(o_hyp, (q, k, v), do, retain_graph=False)
+    # compared in fp32 against the fp32 references, cast once up front
+    o_hyp, gq_hyp, gk_hyp, gv_hyp = o_hyp.float(), gq_hyp.float(), gk_hyp.float(), gv_hyp.float()
 
-    gq_ref, gk_ref, gv_ref = torch.autograd.grad(o_ref, (q, k, v), do)
-    gq_torch, gk_torch, gv_torch = torch.autograd.grad(o_torch, (q, k, v), do)
-    gq_hyp, gk_hyp, gv_hyp = torch.autograd.grad(o_hyp, (q, k, v), do)
+    def torch_path():
+        o_torch = flag_attn.testing.flash_attention(q, k, v, causal=causal, upcast=False)
+        gq_torch, gk_torch, gv_torch = torch.autograd.grad(o_torch, (q, k, v), do, retain_graph=False)
+        return [
+            max_diff(o_torch, o_ref), max_diff(gq_torch, gq_ref),
+            max_diff(gk_torch, gk_ref), max_diff(gv_torch, gv_ref),
+        ]
+    key = (B, H, T, D, P_SEQ, causal, stride_order, dtype, scale, torch.cuda.get_device_name(device_id))
+    o_torch_max_diff, gq_torch_max_diff, gk_torch_max_diff, gv_torch_max_diff = \
+        torch_max_diffs(request, "fwd_bwd", key, torch_path)
 
-    o_torch_max_diff = max_diff(o_torch, o_ref)
-    gq_torch_max_diff = max_diff(gq_torch, gq_ref)
-    gk_torch_max_diff = max_diff(gk_torch, gk_ref)
-    gv_torch_max_diff = max_diff(gv_torch, gv_ref)
+    # everything is queued by now, wait once before checking
+    torch.cuda.synchronize(device_id)
+    report("o hyp", o_hyp, o_ref)
+    assert_close(o_hyp, o_ref, o_torch_max_diff)
+    assert_close(gq_hyp, gq_ref, gq_torch_max_diff)
+    assert_close(gk_hyp, gk_ref, gk_torch_max_diff)
+    assert_close(gv_hyp, gv_ref, gv_torch_max_diff)
+    # the references stay in the module cache, only the per-case tensors go
+    del q, k, v, do, o_hyp, gq_hyp, gk_hyp, gv_hyp
+
+
+@pytest.mark.parametrize('device_id', list(range(torch.cuda.device_count())))
+def test_attention_multi_device(device_id, ref_cache):
+    # a single shape on every device, to check that the kernels launch on and
+    # write to the device the inputs live on
+    B, H, T, D, P_SEQ, causal, dtype = 1, 2, 512, 64, 10, True, torch.float16
+    q_f32, k_f32, v_f32 = get_inputs(ref_cache, B, H, T, D, P_SEQ, 'BHTD', 1.0, device_id)
+    q, k, v = make_leaf(q_f32, dtype), make_leaf(k_f32, dtype), make_leaf(v_f32, dtype)
+    do = get_do(ref_cache, B, H, T, D, 'BHTD', device_id).to(dtype)
 
-    o_triton_max_diff = max_diff(o_hyp, o_ref)
-    gq_triton_max_diff = max_diff(gq_hyp, gq_ref)
-    gk_triton_max_diff = max_diff(gk_hyp, gk_ref)
-    gv_triton_max_diff = max_diff(gv_hyp, gv_ref)
+    g_ref = get_grad_refs(ref_cache, B, H, T, D, P_SEQ, causal, 1.0, device_id)
+    o_ref = get_o_ref(ref_cache, B, H, T, D, P_SEQ, causal, 1.0, device_id)
+    o_torch = flag_attn.testing.flash_attention(q, k, v, causal=causal, upcast=False)
+    o_hyp = flag_attn.flash_attention(q, k, v, causal=causal)
 
-    assert o_triton_max_diff < 2 * o_torch_max_diff + 1e-5
-    assert gq_triton_max_diff < 2 * gq_torch_max_diff + 1e-5
-    assert gk_triton_max_diff < 2 * gk_torch_max_diff + 1e-5
-    assert gv_triton_max_diff < 2 * gv_torch_max_diff + 1e-5
+    g_torch = torch.autograd.grad(o_torch, (q, k, v), do, retain_graph=False)
+    g_hyp = torch.autograd.grad(o_hyp, (q, k, v), do, retain_graph=False)
 
+    refs = (o_ref, *g_ref)
+    torch_diffs = torch.stack([max_diff(t, ref) for t, ref in zip((o_torch, *g_torch), refs)]).tolist()
+    for hyp, ref, torch_diff in zip((o_hyp, *g_hyp), refs, torch_diffs):
+        assert hyp.device == q.device
+        assert_close(hyp, ref, torch_diff)
+    del q, k, v, do, o_torch, o_hyp, g_torch, g_hyp, hyp